@@ -0,0 +1,39 @@
+import re
+
+# Section headers of the DV form in the extracted (lowercased) text, e.g. "dv7" or "dv 7"
+SECTION_PATTERN = re.compile(r'\bdv\s?(\d{1,2})\b')
+
+# Function to split the form text into its DV sections
+def split_sections(text):
+    """
+    Split the extracted form text into its DV sections
+
+    Section headers are matched in increasing order (DV1, DV2, ...), so that a
+    reference to an earlier section inside the text does not start a new section.
+    A header missing from the extracted text (scan artifacts, a label split across
+    lines) is skipped and the next higher header starts the next section.
+
+    Args:
+        text (str): The cleaned text of the whole form
+
+    Returns:
+        dict: Section label ("preamble", "DV1", "DV2", ...) mapped to its text, in form order
+    """
+    sections = {}
+    label, start = "preamble", 0
+    last = 0  # Number of the last accepted section header
+
+    for match in SECTION_PATTERN.finditer(text):
+        number = int(match.group(1))
+        if number <= last:  # Reference to an earlier section, not a header
+            continue
+        sections[label] = text[start:match.start()]
+        label, start = f"DV{number}", match.start()
+        last = number
+
+    sections[label] = text[start:]
+    return sections
+
+# Function to normalize a section label or checklist code for comparison
+def normalize_section_label(label):
+    return str(label).lower().replace(" ", "").replace("-", "")
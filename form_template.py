@@ -0,0 +1,220 @@
+import os
+import fitz  # PyMuPDF for PDF handling
+import json
+import re
+import hashlib
+import time
+from collections import Counter
+
+# Directory holding the learned templates, one JSON file per form version
+TEMPLATE_DIR = os.getenv("FORM_TEMPLATE_DIR", "form_templates")
+
+# Lines starting a DV section, kept as labels for the filled-in content, e.g. "dv7 ..." or "dv 7 ..."
+SECTION_LABEL_PATTERN = re.compile(r'^dv\s?\d{1,2}\b')
+
+# Widget values meaning an empty or unchecked field
+EMPTY_FIELD_VALUES = {"", "off"}
+
+# Function to normalize a line of text the same way extract_pdf_text cleans the document
+def normalize_line(line):
+    return " ".join(line.lower().split())
+
+# Function to fingerprint a normalized line of text
+def line_fingerprint(line):
+    return hashlib.blake2b(line.encode("utf-8"), digest_size=8).hexdigest()
+
+# Function to check whether the centre of a text line lies inside a widget
+def inside_widget(bbox, rects):
+    x, y = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+    return any(rect.x0 <= x <= rect.x1 and rect.y0 <= y <= rect.y1 for rect in rects)
+
+def extract_pdf_items(file_content):
+    """
+    Extract the normalized, non-empty lines of each page of a PDF file in reading order
+
+    Filled-in form fields, checkboxes and signatures are placed among the text
+    lines by their position, so that they stay under their DV section. Each
+    field is labelled with the nearest text line before it (its question),
+    since field names such as "q4" or "Check Box12" carry no context. The
+    rendered text of the widgets is dropped, as the field values replace it.
+
+    Args:
+        file_content (bytes): Content of the PDF file
+
+    Returns:
+        list: One list of (line, is_field) tuples per page, is_field being True
+            for the lines holding a form field value
+    """
+    doc = fitz.open(stream=file_content, filetype="pdf")  # Open the PDF file
+    pages = []
+    for page in doc:  # Iterate through each page
+        widgets = list(page.widgets())
+        rects = [widget.rect for widget in widgets]
+
+        # Text lines with their position, without the text rendered inside widgets
+        items = []
+        for block in page.get_text("dict")["blocks"]:
+            for line in block.get("lines", []):
+                text = normalize_line("".join(span["text"] for span in line["spans"]))
+                if text and not inside_widget(line["bbox"], rects):
+                    items.append((line["bbox"][1], line["bbox"][0], text, False))
+
+        text_lines = sorted(items)
+        for widget in widgets:  # Filled-in form fields, checkboxes and signatures
+            value = normalize_line(str(widget.field_value or ""))
+            if value in EMPTY_FIELD_VALUES:
+                continue
+            # Nearest text line starting above the middle of the field, usually its question
+            middle = (widget.rect.y0 + widget.rect.y1) / 2
+            before = [item for item in text_lines if item[0] <= middle]
+            context = before[-1][2] if before else normalize_line(widget.field_name or "")
+            items.append((widget.rect.y0, widget.rect.x0, f"{context}: {value}", True))
+
+        pages.append([(text, is_field) for _, _, text, is_field in sorted(items)])
+    return pages
+
+# Function to extract the lines of each page of a PDF file, with or without the form field values
+def extract_pdf_lines(file_content, include_fields=True):
+    return [[line for line, is_field in page if include_fields or not is_field]
+            for page in extract_pdf_items(file_content)]
+
+def learn_form_template(samples, version, min_share=1.0):
+    """
+    Learn the static lines of a form version from a blank form or a few filled samples
+
+    A line is static when it appears in at least min_share of the samples. With a
+    single blank form every printed line is static; with filled samples the
+    answers differ between submissions and are left out of the template. Only
+    the printed text is learned: form field values never become static, even
+    when every sample gives the same answer.
+
+    Args:
+        samples (list): Contents (bytes) of the PDF samples of the form version
+        version (str): Name of the form version, e.g. "DV-2022"
+        min_share (float, optional): Share of samples a line must appear in. Defaults to 1.0.
+
+    Returns:
+        dict: The template, with the fingerprints of its static lines
+    """
+    counts = Counter()
+    for sample in samples:
+        lines = {line for page in extract_pdf_lines(sample, include_fields=False) for line in page}
+        counts.update(line_fingerprint(line) for line in lines)
+
+    threshold = min_share * len(samples)
+    return {
+        "version": version,
+        "samples": len(samples),
+        "static_lines": sorted(digest for digest, count in counts.items() if count >= threshold)
+    }
+
+# Function to get the file holding the template of a form version
+def form_template_path(version, template_dir=TEMPLATE_DIR):
+    return os.path.join(template_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', version)}.json")  # Keep the name filesystem safe
+
+# Function to store a learned template
+def save_form_template(template, template_dir=TEMPLATE_DIR):
+    os.makedirs(template_dir, exist_ok=True)
+    template_file = form_template_path(template["version"], template_dir)
+    with open(template_file, "w", encoding="utf-8") as f:
+        json.dump(template, f, indent=4)
+    return template_file
+
+# Function to load a stored template, None if the form version was never learned
+def load_form_template(version, template_dir=TEMPLATE_DIR):
+    template_file = form_template_path(version, template_dir)
+    if not os.path.exists(template_file):
+        return None
+    with open(template_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def extract_filled_text(file_content, template):
+    """
+    Extract only the filled-in content of a form, dropping the printed template
+
+    Lines of the template (questions, instructions, legal text) are removed.
+    Filled-in answers, checked boxes and signatures are kept, each group preceded
+    by the label of the DV section it belongs to. Form field values are always
+    kept, whatever the template.
+
+    Args:
+        file_content (bytes): Content of the PDF file to extract
+        template (dict): The template of the form version, from learn_form_template
+
+    Returns:
+        str: The cleaned filled-in text, in the format of extract_pdf_text
+    """
+    static_lines = set(template["static_lines"])
+    kept = []
+    label, label_emitted = None, True
+
+    for page in extract_pdf_items(file_content):
+        for line, is_field in page:
+            is_static = not is_field and line_fingerprint(line) in static_lines
+            if SECTION_LABEL_PATTERN.match(line):
+                label, label_emitted = line, False  # Remember the label until the section has content
+                if is_static:
+                    continue
+            elif is_static:
+                continue
+
+            if not label_emitted:
+                kept.append(label)  # Emit the section label before its first answer
+                label_emitted = True
+            if line != label:
+                kept.append(line)
+
+    return " ".join(kept)
+
+# Example usage:
+if __name__ == "__main__":
+    # This is just for testing/demonstration purposes: measure the reduction on synthetic DV forms
+    from specialized_only import extract_pdf_text
+
+    legal_text = [
+        "Le vendeur déclare que les renseignements ci-dessous sont exacts à sa connaissance.",
+        "Cette déclaration ne constitue pas une garantie de la part du vendeur.",
+        "Le courtier doit remettre une copie de ce formulaire à l'acheteur.",
+        "Si oui, précisez et joignez tout rapport, facture ou document pertinent.",
+    ]
+
+    def synthetic_form(answers):
+        doc = fitz.open()
+        page, y = doc.new_page(), 40
+        for section in range(1, 17):
+            lines = [f"DV{section} Questions sur l'immeuble, section {section}"] + legal_text
+            lines += [f"{section}.{q} L'immeuble a-t-il fait l'objet de travaux ? Oui Non" for q in range(1, 4)]
+            lines += answers.get(section, [])
+            for line in lines:
+                if y > 800:
+                    page, y = doc.new_page(), 40
+                page.insert_text((40, y), line, fontsize=8)
+                y += 11
+        return doc.tobytes()
+
+    blank = synthetic_form({})
+    filled = synthetic_form({
+        4: ["Oui, infiltration d'eau au sous-sol en 2019, réparée par Drains Plus."],
+        7: ["Rapport d'inspection joint, 12 mars 2021."],
+        16: ["Signé: Jean Gérard, Pierrette Tremblay, 24/01/2029"],
+    })
+
+    template = learn_form_template([blank], version="synthetic-dv")
+    full_text = extract_pdf_text(filled)
+    filled_text = extract_filled_text(filled, template)
+
+    # Substring matching cost of the clause checks on both texts
+    points = ["rapport d'inspection", "infiltration d'eau", "pyrite", "jean gérard"] * 50
+    start = time.perf_counter()
+    for _ in range(100):
+        [point in full_text for point in points]
+    full_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(100):
+        [point in filled_text for point in points]
+    filled_time = time.perf_counter() - start
+
+    print(f"Filled-in text: {filled_text}\n")
+    print(f"Characters: {len(full_text)} -> {len(filled_text)} ({100 * len(filled_text) / len(full_text):.1f}%)")
+    print(f"Approx. prompt tokens: {len(full_text) // 4} -> {len(filled_text) // 4}")
+    print(f"Matching time: {full_time * 1000:.1f}ms -> {filled_time * 1000:.1f}ms")
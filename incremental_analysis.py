@@ -0,0 +1,290 @@
+import os
+import pandas as pd
+import json
+import re
+import hashlib
+import tempfile
+from io import BytesIO
+from datetime import datetime
+from pdf_extraction import iter_pdf_page_text
+from form_sections import split_sections, normalize_section_label
+from specialized_only import (
+    SPECIALIZED_INSTRUCTION,
+    SPECIALIZED_REPORT_SCHEMA,
+    analyze_real_estate_document_json,
+    call_agent_json,
+    specialized_json_to_markdown,
+)
+
+# Directory holding the fingerprints and per-section results of previously analyzed forms
+CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", ".analysis_cache")
+
+# Statuses a section can get
+SECTION_STATUSES = ["Conforme", "Partiellement conforme", "Non conforme"]
+
+# Appended to the instruction when only some sections of the form are analyzed
+SECTION_JSON_FORMAT = """  Only the sections listed below are analyzed in this request. Return a single JSON object matching the JSON schema given below and nothing else, with exactly one entry in sections per listed section (use the section label as given, e.g. DV7). Give each section a status and a conformity score between 0 and 100, and attach the recommended actions and warnings that concern that section. Fill vendor, date and property_type only if that information appears in the text below, otherwise use empty strings."""
+
+# JSON schema of the per-section results, sharing the action and warning items of the specialized report
+SECTION_RESULTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "section": {"type": "string"},
+                    "status": {"type": "string", "enum": SECTION_STATUSES},
+                    "score": {"type": "number"},
+                    "recommended_actions": SPECIALIZED_REPORT_SCHEMA["properties"]["recommended_actions"],
+                    "warnings": SPECIALIZED_REPORT_SCHEMA["properties"]["warnings"]
+                },
+                "required": ["section", "status", "score", "recommended_actions", "warnings"],
+                "additionalProperties": False
+            }
+        },
+        "vendor": {"type": "string"},
+        "date": {"type": "string"},
+        "property_type": {"type": "string"}
+    },
+    "required": ["sections", "vendor", "date", "property_type"],
+    "additionalProperties": False
+}
+
+# Function to extract the cleaned text of each page of a PDF file
+def extract_pdf_pages(file_content):
+    return list(iter_pdf_page_text(file_content))  # Clean up each page
+
+# Function to fingerprint a piece of text
+def fingerprint(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Function to get the file holding the stored analysis of a form
+def form_state_path(form_id, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', form_id)}.json")  # Keep the id filesystem safe
+
+# Keys of a stored form state, a state missing any of them is not reused
+FORM_STATE_KEYS = ["checklist_hash", "page_hashes", "section_hashes", "section_results", "document_fields"]
+
+# Function to load the stored analysis of a form, None if there is none or it cannot be read
+def load_form_state(form_id, cache_dir=CACHE_DIR):
+    state_file = form_state_path(form_id, cache_dir)
+    if not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable state of {form_id}: {str(e)}")  # Re-analyze the whole form
+        return None
+    if not isinstance(state, dict) or any(key not in state for key in FORM_STATE_KEYS):
+        return None
+    return state
+
+# Function to store the analysis of a form for the next revision
+def save_form_state(form_id, state, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    state_file = form_state_path(form_id, cache_dir)
+    # Write to a temporary file first, so that an interrupted or concurrent write never leaves a truncated state
+    handle, temp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=4, ensure_ascii=False)
+        os.replace(temp_file, state_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    return state_file
+
+# Function to merge the per-section results into the specialized result dict
+def merge_section_results(section_results, document_fields):
+    """
+    Merge cached and new per-section results into the specialized result dict
+
+    Args:
+        section_results (dict): Section label mapped to its result, in form order
+        document_fields (dict): vendor, date and property_type of the form
+
+    Returns:
+        dict: The specialized analysis in JSON format, with the per-section results under "sections"
+    """
+    results = list(section_results.values())
+
+    # Overall score is the mean of the section scores
+    overall_score = round(sum(r["score"] for r in results) / len(results)) if results else 0
+
+    attention = [r["section"] for r in results if r["status"] != "Conforme"]
+    summary = f"{len(results) - len(attention)} of {len(results)} sections are conforming."
+    if attention:
+        summary += f" Sections requiring attention: {', '.join(attention)}."
+
+    return {
+        "summary": summary,
+        "recommended_actions": [action for r in results for action in r["recommended_actions"]],
+        "warnings": [warning for r in results for warning in r["warnings"]],
+        "vendor": document_fields.get("vendor", ""),
+        "date": document_fields.get("date", ""),
+        "property_type": document_fields.get("property_type", ""),
+        "overall_score": str(overall_score),
+        "sections": results
+    }
+
+def analyze_revised_document_json(pdf_file_content, checklist_file_content, form_id, api_key=None, cache_dir=CACHE_DIR):
+    """
+    Analyze a revision of a real estate document, re-analyzing only the sections
+    that changed since the stored previous version of the same form
+
+    The first analysis of a form (or an analysis with a different checklist)
+    covers every section. Later revisions are fingerprinted page by page and
+    section by section; unchanged sections reuse their cached results and the
+    overall score is recomputed from the merged results. Forms in which no DV
+    section header is found (scans, other label formats), or whose sections do not
+    match the codes of the checklist, fall back to the full structured analysis
+    instead of being scored on a subset of the sections.
+
+    Args:
+        pdf_file_content (bytes): Content of the PDF file to analyze
+        checklist_file_content (bytes): Content of the Excel checklist file
+        form_id (str): Identifier of the form shared by all of its revisions
+        api_key (str, optional): API key for OpenRouter. Defaults to environment variable.
+        cache_dir (str, optional): Directory of the stored analyses. Defaults to CACHE_DIR.
+
+    Returns:
+        dict: A dictionary containing:
+            - json_output (dict): The specialized analysis in JSON format
+            - markdown_report (str): The specialized analysis in markdown format
+            - json_file (str): Path to the stored state of the form
+            - reanalyzed_sections (list): Sections sent to the model
+            - reused_sections (list): Sections taken from the previous analysis
+            - incremental (bool): False when the form fell back to the full analysis
+            - usage (dict): Token usage and latency of the API calls
+            - timestamp (str): Timestamp when the analysis was performed
+    """
+    try:
+        # Extract and fingerprint the pages of the uploaded PDF
+        pages = extract_pdf_pages(pdf_file_content)
+        page_hashes = [fingerprint(page) for page in pages]
+        sections = split_sections("".join(pages))
+        section_hashes = {label: fingerprint(text) for label, text in sections.items()}
+
+        # Read the checklist, each of its codes must match a section found in the form
+        checklist = pd.read_excel(BytesIO(checklist_file_content))
+        codes = set(checklist["Code form."].map(normalize_section_label))
+        found = {normalize_section_label(label) for label in sections if label != "preamble"}
+
+        if not found or not codes <= found:
+            # Sections cannot be diffed or would not cover the checklist: analyze the whole form
+            print(f"Sections of {form_id} do not match the checklist, running the full analysis")
+            results = analyze_real_estate_document_json(pdf_file_content, checklist_file_content,
+                                                        api_key=api_key, structured=True)
+            return dict(results, reanalyzed_sections=[], reused_sections=[], incremental=False)
+
+        checklist_hash = hashlib.sha256(checklist_file_content).hexdigest()
+
+        # Only reuse a previous analysis made with the same checklist
+        previous = load_form_state(form_id, cache_dir)
+        if previous is None or previous["checklist_hash"] != checklist_hash:
+            previous = {"page_hashes": [], "section_hashes": {}, "section_results": {}, "document_fields": {}}
+
+        usage = {}  # Token usage and latency of the API calls
+        document_fields = dict(previous["document_fields"])
+        section_results = {}
+
+        if page_hashes == previous["page_hashes"]:
+            changed = []  # Identical upload, nothing to re-analyze
+        else:
+            changed = [label for label, digest in section_hashes.items()
+                       if previous["section_hashes"].get(label) != digest
+                       or (label != "preamble" and label not in previous["section_results"])]
+
+        changed_dv = [label for label in changed if label != "preamble"]
+        if changed:
+            # Keep the checklist rows of the changed sections only
+            wanted = {normalize_section_label(label) for label in changed_dv}
+            rows = checklist[checklist["Code form."].map(normalize_section_label).isin(wanted)]
+            if not changed_dv:
+                rows = "None"  # Only the preamble changed, no clause to check
+
+            changed_text = "\n\n".join(f"### {label}\n{sections[label]}" for label in changed)
+            full_prompt = SPECIALIZED_INSTRUCTION + SECTION_JSON_FORMAT + \
+                f"""\n\n Sections: {', '.join(changed_dv)} \n\n Analyse:{changed_text} \n\n Using: {rows}"""
+            answer = call_agent_json(full_prompt, SECTION_RESULTS_SCHEMA, "section_results",
+                                     api_key=api_key, stats=usage)
+
+            new_results = {normalize_section_label(r["section"]): r for r in answer["sections"]}
+            missing = [label for label in changed_dv if normalize_section_label(label) not in new_results]
+            if missing:
+                raise ValueError(f"No result returned for sections: {', '.join(missing)}")
+
+            for label in changed_dv:
+                section_results[label] = dict(new_results[normalize_section_label(label)], section=label)
+
+            # Keep the previous document fields unless the model found new ones
+            for key in ("vendor", "date", "property_type"):
+                if answer[key]:
+                    document_fields[key] = answer[key]
+
+        # Merge the new results with the cached ones, in form order
+        reused = [label for label in sections if label != "preamble" and label not in section_results]
+        for label in reused:
+            section_results[label] = previous["section_results"][label]
+        section_results = {label: section_results[label] for label in sections if label in section_results}
+
+        json_output = merge_section_results(section_results, document_fields)
+
+        # Store the fingerprints and results for the next revision
+        json_file = save_form_state(form_id, {
+            "checklist_hash": checklist_hash,
+            "page_hashes": page_hashes,
+            "section_hashes": section_hashes,
+            "section_results": section_results,
+            "document_fields": document_fields
+        }, cache_dir)
+
+        return {
+            "json_output": json_output,
+            "markdown_report": specialized_json_to_markdown(json_output),
+            "json_file": json_file,
+            "reanalyzed_sections": changed_dv,
+            "reused_sections": reused,
+            "incremental": True,
+            "usage": usage,
+            "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S")
+        }
+
+    except Exception as e:
+        print(f"Error analyzing document: {str(e)}")
+        return {
+            "error": str(e),
+            "json_output": None,
+            "markdown_report": None,
+            "json_file": None,
+            "reanalyzed_sections": [],
+            "reused_sections": [],
+            "incremental": True,
+            "usage": {},
+            "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S")
+        }
+
+# Example usage:
+if __name__ == "__main__":
+    # This is just for testing/demonstration purposes
+    with open("form-dv-test-2.pdf", "rb") as pdf_file, open("formulaires-analyse-vt (DV).xlsx", "rb") as excel_file:
+        pdf_content = pdf_file.read()
+        excel_content = excel_file.read()
+
+        # The second run of the same upload is served from the stored analysis
+        for run in ("initial", "revision"):
+            results = analyze_revised_document_json(pdf_content, excel_content, form_id="form-dv-test-2")
+
+            if "error" in results:
+                print(f"Analysis failed ({run}): {results['error']}")
+                continue
+
+            print(f"Analysis completed successfully ({run})")
+            print(f"Re-analyzed sections: {', '.join(results['reanalyzed_sections']) or 'None'}")
+            print(f"Reused sections: {len(results['reused_sections'])}")
+            print(f"Overall Score: {results['json_output']['overall_score']}%")
+            print(f"Output tokens: {results['usage'].get('completion_tokens', 0)}")
+            print(f"Latency: {results['usage'].get('latency_s', 0.0)}s\n")
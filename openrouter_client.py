@@ -0,0 +1,209 @@
+import os
+import json
+import random
+import threading
+import time
+import requests
+from datetime import timedelta
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Client-side limits, shared by every caller in the process
+REQUESTS_PER_MINUTE = int(os.getenv("OPENROUTER_REQUESTS_PER_MINUTE", "60"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENROUTER_TOKENS_PER_MINUTE", "200000"))
+MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "8"))
+INITIAL_CONCURRENCY = int(os.getenv("OPENROUTER_INITIAL_CONCURRENCY", "2"))
+
+MAX_RETRIES = 4                     # Retries of a throttled request before giving up
+REQUEST_TIMEOUT = (10, int(os.getenv("OPENROUTER_TIMEOUT", "300")))  # Connect and read timeouts, in seconds
+EXPECTED_COMPLETION_TOKENS = 2000   # Output tokens assumed when estimating the cost of a request
+DECREASE_COOLDOWN = 2.0             # Seconds during which further throttles do not shrink the limit again
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a rate per minute
+
+    The bucket may go into debt when the real cost of a request turns out
+    higher than its estimate; new requests then wait until it refills.
+    """
+
+    def __init__(self, rate_per_minute, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0  # Tokens per second
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until the amount can be taken, 0 if it can be taken now
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)  # A request larger than the bucket waits for a full bucket
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    # Charge (or refund) the difference between the real and the estimated cost
+    def adjust(self, amount):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class AdaptiveScheduler:
+    """
+    Admission control for the OpenRouter API
+
+    Requests wait for a concurrency slot, a request token and their estimated
+    tokens. The concurrency limit follows AIMD: it grows by one after a full
+    window of successful requests and is halved on 429 and 5xx responses.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_concurrency=MAX_CONCURRENCY, initial_concurrency=INITIAL_CONCURRENCY, clock=time.monotonic):
+        self.requests = TokenBucket(requests_per_minute, clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock)
+        self.max_concurrency = max_concurrency
+        self.limit = max(1, min(initial_concurrency, max_concurrency))
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.successes = 0           # Successful requests since the last limit change
+        self.throttle_events = 0
+        self.paused_until = 0.0      # Set from Retry-After, no request starts before it
+        self.last_decrease = float("-inf")
+
+    def acquire(self, estimated_tokens):
+        with self.condition:
+            self.waiting += 1
+            try:
+                while True:
+                    wait = self.paused_until - self.clock()
+                    if self.in_flight < self.limit and wait <= 0:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                        if wait <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(estimated_tokens)
+                            self.in_flight += 1
+                            return
+                    # Wait for a released slot, or for the buckets to refill
+                    self.condition.wait(timeout=wait if wait > 0 else None)
+            finally:
+                self.waiting -= 1
+
+    # Free a slot; outcome is "success", "throttled" (429/5xx) or "error" (no effect on the limit)
+    def release(self, outcome="success", retry_after=None, token_correction=0):
+        with self.condition:
+            self.in_flight -= 1
+            if token_correction:
+                self.tokens.adjust(token_correction)
+
+            if outcome == "throttled":
+                self.throttle_events += 1
+                self.successes = 0
+                now = self.clock()
+                if now - self.last_decrease >= DECREASE_COOLDOWN:  # One decrease per burst of throttles
+                    self.limit = max(1, self.limit // 2)
+                    self.last_decrease = now
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif outcome == "success":
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "current_limit": self.limit,
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "throttle_events": self.throttle_events,
+                "requests_per_minute": round(self.requests.rate * 60),
+                "tokens_per_minute": round(self.tokens.rate * 60)
+            }
+
+# Scheduler shared by all callers in the process
+SCHEDULER = AdaptiveScheduler()
+
+# Function to get the current limit, queue depth and throttle events of the shared scheduler
+def get_scheduler_stats():
+    return SCHEDULER.stats()
+
+# Function to estimate the tokens used by a chat completion request
+def estimate_tokens(payload):
+    prompt_chars = sum(len(message["content"]) for message in payload["messages"])
+    return prompt_chars // 4 + EXPECTED_COMPLETION_TOKENS  # About 4 characters per token
+
+# Function to get the real token usage of a successful response, None if it cannot be read
+def response_total_tokens(response):
+    try:
+        usage = response.json().get("usage") or {}
+        return int(usage["total_tokens"])
+    except (ValueError, AttributeError, KeyError, TypeError):
+        return None
+
+# Function to read the Retry-After header of a throttled response, in seconds
+def retry_after_seconds(response):
+    try:
+        return float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+def post_chat_completion(payload, headers, scheduler=None):
+    """
+    Send a chat completion request through the shared scheduler
+
+    429 and 5xx responses shrink the concurrency limit and are retried with
+    exponential backoff (or after Retry-After) up to MAX_RETRIES times.
+    Each attempt times out after REQUEST_TIMEOUT.
+
+    Args:
+        payload (dict): The chat completion request
+        headers (dict): The request headers
+        scheduler (AdaptiveScheduler, optional): Scheduler to use. Defaults to SCHEDULER.
+
+    Returns:
+        requests.Response: The last response received; its elapsed attribute is the
+            duration of that HTTP attempt, body included, without queueing or backoff
+    """
+    scheduler = scheduler or SCHEDULER
+    estimated_tokens = estimate_tokens(payload)
+
+    for attempt in range(MAX_RETRIES + 1):
+        scheduler.acquire(estimated_tokens)
+        outcome, retry_after, token_correction = "error", None, 0
+        try:
+            start = time.perf_counter()
+            response = requests.post(OPENROUTER_URL, headers=headers, data=json.dumps(payload),
+                                     timeout=REQUEST_TIMEOUT)
+            response.elapsed = timedelta(seconds=time.perf_counter() - start)  # Whole attempt, body included
+            if response.status_code == 429 or response.status_code >= 500:
+                outcome, retry_after = "throttled", retry_after_seconds(response)
+            else:
+                outcome = "success"
+                # Charge the real token usage of the request against its estimate
+                total_tokens = response_total_tokens(response) if response.status_code == 200 else None
+                if total_tokens:
+                    token_correction = total_tokens - estimated_tokens
+        finally:
+            # Always free the slot; transport errors do not count as successes
+            scheduler.release(outcome=outcome, retry_after=retry_after, token_correction=token_correction)
+
+        if outcome == "throttled" and attempt < MAX_RETRIES:
+            delay = retry_after or min(2 ** attempt, 30) + random.uniform(0, 1)  # Backoff with jitter
+            print(f"OpenRouter returned {response.status_code}, retrying in {delay:.1f}s")  # Log throttle
+            time.sleep(delay)
+            continue
+        return response
@@ -0,0 +1,111 @@
+import os
+import io
+import re
+import mmap
+import fitz  # PyMuPDF for PDF handling
+
+# Newlines and pairs of spaces/newlines, replaced by a single space in one pass.
+# Equivalent to text.replace("\n", " ").replace("  ", " ") as done by extract_pdf_text.
+WHITESPACE_PATTERN = re.compile(r'[ \n]{2}|\n')
+
+# Function to clean the text of a single page
+def normalize_page_text(text):
+    return WHITESPACE_PATTERN.sub(" ", text.lower())
+
+# Function to open a PDF from a path, a buffer or a file-like object without copying it
+def open_pdf(source):
+    """
+    Open a PDF document without copying its content in Python
+
+    Args:
+        source: A file path (str or os.PathLike), bytes, a buffer (mmap, memoryview,
+            bytearray) or a file-like object such as io.BytesIO or a Streamlit upload
+
+    Returns:
+        fitz.Document: The opened document
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return fitz.open(source)  # MuPDF reads the file itself
+    if isinstance(source, io.BytesIO):
+        return fitz.open(stream=source.getbuffer(), filetype="pdf")  # View on the upload, no copy
+    if isinstance(source, bytes):
+        return fitz.open(stream=source, filetype="pdf")
+    if isinstance(source, (mmap.mmap, memoryview, bytearray)):
+        return fitz.open(stream=memoryview(source), filetype="pdf")  # View on the buffer, no copy
+    return fitz.open(stream=source.read(), filetype="pdf")  # Other file-like objects must be read
+
+def iter_pdf_page_text(source):
+    """
+    Yield the cleaned text of a PDF page by page
+
+    Only one page of text is held at a time, so memory stays bounded by the
+    largest page rather than by the document. Pass a file path or a
+    memory-mapped buffer to avoid holding the PDF itself in Python memory.
+
+    Args:
+        source: The PDF, as accepted by open_pdf
+
+    Yields:
+        str: The cleaned text of each page
+    """
+    doc = open_pdf(source)
+    try:
+        for page in doc:  # Iterate through each page
+            yield normalize_page_text(page.get_text())
+    finally:
+        doc.close()  # Release the buffer, e.g. so that a mmap can be closed
+
+# Function to extract the cleaned text of a whole PDF, building the document string only once
+def extract_pdf_text_from(source):
+    return "".join(iter_pdf_page_text(source))
+
+# Example usage:
+if __name__ == "__main__":
+    # This is just for testing/demonstration purposes: compare peak memory with the current extraction
+    import tempfile
+    import time
+    import tracemalloc
+
+    # Build a text heavy synthetic packet
+    doc = fitz.open()
+    line = "Le vendeur déclare que les renseignements ci-dessous sont exacts à sa connaissance.  "
+    for page_number in range(300):
+        page = doc.new_page()
+        for row in range(70):
+            page.insert_text((30, 30 + row * 11), f"DV{page_number % 16 + 1} {line}", fontsize=8)
+    pdf_path = os.path.join(tempfile.mkdtemp(), "synthetic_packet.pdf")
+    doc.save(pdf_path)
+    doc.close()
+
+    # Current extraction: whole upload in memory, concatenation and full-size cleaning copies
+    def current_extraction(path):
+        with open(path, "rb") as f:
+            document = fitz.open(stream=f.read(), filetype="pdf")
+        text = ""
+        for page in document:
+            text += page.get_text()
+        return text.lower().replace("\n", " ").replace("  ", " ")
+
+    # Page by page from a memory-mapped file, keeping only a per-page result
+    def streamed_from_mmap(path):
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return sum("rapport" in page for page in iter_pdf_page_text(buffer))
+
+    benchmarks = [
+        ("extract_pdf_text (current)", current_extraction),
+        ("extract_pdf_text_from (path)", extract_pdf_text_from),
+        ("iter_pdf_page_text (path)", lambda path: sum("rapport" in page for page in iter_pdf_page_text(path))),
+        ("iter_pdf_page_text (mmap)", streamed_from_mmap),
+    ]
+
+    assert current_extraction(pdf_path) == extract_pdf_text_from(pdf_path)
+
+    print(f"PDF size: {os.path.getsize(pdf_path) / 1e6:.1f} MB")
+    for name, extraction in benchmarks:
+        tracemalloc.start()
+        start = time.perf_counter()
+        extraction(pdf_path)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: peak {peak / 1e6:.1f} MB, {elapsed:.2f}s")
@@ -0,0 +1,192 @@
+import os
+import numpy as np
+import pandas as pd
+from io import BytesIO
+from pdf_extraction import extract_pdf_text_from
+
+# Clause statuses, indexed by the status codes of the compliance matrix
+STATUS_LABELS = ["✅ Conforme", "🟡 Partiellement conforme", "🔴 Non conforme"]
+
+# Prefix of the validation point columns, keeping them apart from the "document" and "error" columns
+POINT_COLUMN_PREFIX = "point:"
+
+def compile_checklist(checklist):
+    """
+    Compile a checklist into the validation points shared by all documents of an audit
+
+    Validation points are split and cleaned the same way as in
+    analyze_real_estate_document, and each distinct point is matched only once
+    per document even when several clauses use it.
+
+    Args:
+        checklist (pd.DataFrame): The checklist, with "Code form.", "Nom de la clause"
+            and "Éléments de validation" columns
+
+    Returns:
+        dict: A dictionary containing:
+            - clause_ids (list): Clause id of each clause
+            - clause_names (list): Clause name of each clause
+            - points (list): Distinct validation points
+            - membership (np.ndarray): points x clauses count of each point in each clause
+            - rapport_points (np.ndarray): Points whose absence makes a clause non conforming
+    """
+    points_index = {}  # Validation point mapped to its column in the matrix
+    pairs = []         # (point column, clause column) of each validation point of each clause
+
+    for clause, validations in enumerate(checklist["Éléments de validation"].map(str)):
+        for point in validations.split("-"):  # Same split and clean up as the per-document check
+            point = point.strip().lower()
+            if point:
+                pairs.append((points_index.setdefault(point, len(points_index)), clause))
+
+    membership = np.zeros((len(points_index), len(checklist)), dtype=np.int32)
+    for point, clause in pairs:
+        membership[point, clause] += 1
+
+    points = list(points_index)
+    return {
+        "clause_ids": checklist["Code form."].map(str).tolist(),
+        "clause_names": checklist["Nom de la clause"].map(str).tolist(),
+        "points": points,
+        "membership": membership,
+        "rapport_points": np.array(["rapport" in point for point in points], dtype=bool)
+    }
+
+# Function to check which validation points of a compiled checklist a document contains
+def coverage_row(text, compiled):
+    points = compiled["points"]
+    return np.fromiter((point in text for point in points), dtype=bool, count=len(points))
+
+# Function to derive the clause status codes from the coverage matrix, for all documents at once
+def clause_status_codes(coverage, compiled):
+    missing = ~coverage
+    missing_counts = missing.astype(np.int32) @ compiled["membership"]
+    missing_rapport = (missing & compiled["rapport_points"]).astype(np.int32) @ compiled["membership"]
+    return np.where(missing_rapport > 0, 2, np.where(missing_counts > 0, 1, 0)).astype(np.int8)
+
+def build_compliance_matrix(doc_texts, compiled):
+    """
+    Check the validation points of a compiled checklist against N documents at once
+
+    Args:
+        doc_texts (list): Cleaned text of each document, as returned by extract_pdf_text
+        compiled (dict): The checklist compiled by compile_checklist
+
+    Returns:
+        tuple: (coverage, status) where coverage is the documents x points boolean
+            matrix of the points found in each document, and status the
+            documents x clauses matrix of status codes (indexes in STATUS_LABELS)
+    """
+    coverage = np.zeros((len(doc_texts), len(compiled["points"])), dtype=bool)
+    for row, text in enumerate(doc_texts):
+        coverage[row] = coverage_row(text, compiled)
+    return coverage, clause_status_codes(coverage, compiled)
+
+def audit_portfolio(pdf_sources, checklist_file_content, document_names=None):
+    """
+    Audit N documents against one checklist
+
+    Each document is matched as soon as it is extracted, so only one document
+    text is held at a time. A document that cannot be extracted does not stop
+    the audit: its error is recorded and its clause statuses are left empty.
+
+    Args:
+        pdf_sources (list): The PDFs, as file paths or anything accepted by extract_pdf_text_from
+        checklist_file_content (bytes): Content of the Excel checklist file
+        document_names (list, optional): Name of each document. Defaults to the file names.
+
+    Returns:
+        dict: A dictionary containing:
+            - coverage (pd.DataFrame): One row per document, one boolean column per validation point
+              (named POINT_COLUMN_PREFIX + point)
+            - clause_status (pd.DataFrame): One row per document, one status column per clause
+    """
+    checklist = pd.read_excel(BytesIO(checklist_file_content))
+    compiled = compile_checklist(checklist)
+
+    if document_names is None:
+        document_names = [os.path.basename(str(source)) if isinstance(source, (str, os.PathLike)) else f"document_{index}"
+                          for index, source in enumerate(pdf_sources)]
+
+    coverage = np.zeros((len(pdf_sources), len(compiled["points"])), dtype=bool)
+    errors = [None] * len(pdf_sources)  # Extraction error of each document, if any
+    for row, source in enumerate(pdf_sources):
+        try:
+            coverage[row] = coverage_row(extract_pdf_text_from(source), compiled)
+        except Exception as e:
+            print(f"Error extracting {document_names[row]}: {str(e)}")
+            errors[row] = str(e)
+
+    status = clause_status_codes(coverage, compiled)
+    status[[error is not None for error in errors]] = -1  # No status for documents that could not be read
+
+    return compliance_frames(document_names, compiled, coverage, status, errors)
+
+# Function to turn the compliance matrices into columnar tables
+def compliance_frames(document_names, compiled, coverage, status, errors=None):
+    coverage_frame = pd.DataFrame(coverage, columns=[POINT_COLUMN_PREFIX + point for point in compiled["points"]])
+    coverage_frame.insert(0, "document", document_names)
+
+    # Checklist rows sharing an id and a name get their row index, so that no column overwrites another
+    clause_columns = [f"{clause_id} - {name}" for clause_id, name in zip(compiled["clause_ids"], compiled["clause_names"])]
+    clause_columns = [f"{column} (row {index})" if clause_columns.count(column) > 1 else column
+                      for index, column in enumerate(clause_columns)]
+    status_frame = pd.DataFrame(
+        {column: pd.Categorical.from_codes(status[:, index], categories=STATUS_LABELS)
+         for index, column in enumerate(clause_columns)}
+    )
+    status_frame.insert(0, "document", document_names)
+
+    if errors is not None:
+        coverage_frame.insert(1, "error", errors)
+        status_frame.insert(1, "error", errors)
+
+    return {"coverage": coverage_frame, "clause_status": status_frame}
+
+# Function to export the audit as Parquet files
+def export_audit(audit, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    for name, frame in audit.items():  # coverage and clause_status
+        files[name] = os.path.join(output_dir, f"{name}.parquet")
+        frame.to_parquet(files[name], index=False)
+    return files
+
+# Function to list the documents missing any validation point containing the given text
+def documents_missing(coverage, text):
+    columns = [column for column in coverage.columns
+               if column.startswith(POINT_COLUMN_PREFIX) and text.lower() in column[len(POINT_COLUMN_PREFIX):]]
+    if not columns:
+        return []
+    readable = coverage["error"].isna() if "error" in coverage.columns else True  # Unreadable documents are not counted
+    return coverage.loc[~coverage[columns].all(axis=1) & readable, "document"].tolist()
+
+# Example usage:
+if __name__ == "__main__":
+    # This is just for testing/demonstration purposes: audit synthetic documents
+    import random
+    import tempfile
+    import time
+
+    checklist = pd.DataFrame({
+        "Code form.": [f"DV{i}" for i in range(1, 17)],
+        "Nom de la clause": [f"Clause {i}" for i in range(1, 17)],
+        "Éléments de validation": [f"- réponse dv{i} - précisions dv{i} - rapport d'inspection dv{i}" for i in range(1, 17)]
+    })
+    compiled = compile_checklist(checklist)
+
+    random.seed(0)
+    doc_texts = [" ".join(point for point in compiled["points"] if random.random() < 0.9) for _ in range(5000)]
+    document_names = [f"form_{index}.pdf" for index in range(len(doc_texts))]
+
+    start = time.perf_counter()
+    coverage, status = build_compliance_matrix(doc_texts, compiled)
+    audit = compliance_frames(document_names, compiled, coverage, status)
+    print(f"Matrix for {coverage.shape[0]} documents x {coverage.shape[1]} points: {time.perf_counter() - start:.2f}s")
+
+    files = export_audit(audit, tempfile.mkdtemp())
+    coverage_frame = pd.read_parquet(files["coverage"])
+
+    start = time.perf_counter()
+    lacking = documents_missing(coverage_frame, "rapport d'inspection dv7")
+    print(f"Forms lacking the DV7 inspection rapport: {len(lacking)} ({(time.perf_counter() - start) * 1000:.1f}ms)")
@@ -1,10 +1,7 @@
 import os
-import fitz  # PyMuPDF for PDF handling
 import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
-import requests
-import json
 import re
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
@@ -15,6 +12,8 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, Tabl
 from reportlab.lib import colors
 from reportlab.pdfbase.pdfmetrics import stringWidth
 from datetime import datetime
+from pdf_extraction import extract_pdf_text_from
+from openrouter_client import post_chat_completion, get_scheduler_stats
 
 # Load API key from environment variables
 load_dotenv()
@@ -23,11 +22,7 @@ MODEL = "anthropic/claude-3.5-sonnet"  # Model to be used for API calls
 
 # Function to extract text from a PDF file
 def extract_pdf_text(file):
-    doc = fitz.open(stream=file.read(), filetype="pdf")  # Open the PDF file
-    text = ""
-    for page in doc:  # Iterate through each page
-        text += page.get_text()  # Extract text from the page
-    return text.lower().replace("\n", " ").replace("  ", " ")  # Clean up the text
+    return extract_pdf_text_from(file)  # Read the upload in place and clean up the text page by page
 
 # Function to call the Claude AI agent with a prompt
 def call_agent(prompt, model=MODEL, temperature=0):
@@ -43,12 +38,8 @@ def call_agent(prompt, model=MODEL, temperature=0):
         "temperature": 0  # Add temperature parameter to control randomness
     }
 
-    # Make a POST request to the AI API
-    response = requests.post(
-        "https://openrouter.ai/api/v1/chat/completions",
-        headers=headers,
-        data=json.dumps(payload)  # Convert payload to JSON
-    )
+    # Make a POST request to the AI API, paced by the shared rate limiter
+    response = post_chat_completion(payload, headers)
 
     if response.status_code == 200:
         return response.json()["choices"][0]["message"]["content"]  # Return the AI's response
@@ -284,6 +275,10 @@ st.set_page_config(page_title="Document Analysis System", page_icon="📄", layo
 st.title("📋 Real Estate Compliance Analyzer")
 st.markdown("Upload a document to analyze and a validation table for reference")
 
+# Show the state of the OpenRouter rate limiter shared by all analyses in this process
+with st.sidebar.expander("API rate limiting"):
+    st.json(get_scheduler_stats())
+
 col1, col2 = st.columns(2)
 with col1:
     uploaded_form = st.file_uploader("Upload completed PDF form", type=["pdf"])  # PDF upload
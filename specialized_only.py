@@ -1,28 +1,77 @@
 import os
-import fitz  # PyMuPDF for PDF handling
 import pandas as pd
 from dotenv import load_dotenv
-import requests
 import json
 from io import BytesIO
 from datetime import datetime
 import re
+import time
+from form_template import extract_filled_text
+from pdf_extraction import extract_pdf_text_from
+from openrouter_client import post_chat_completion
 
 # Load API key from environment variables
 load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 MODEL = "anthropic/claude-3-sonnet"  # Model to be used for API calls
 
+# Instruction shared by the markdown and structured specialized analyses
+SPECIALIZED_INSTRUCTION = """<Instruction> You are an expert real estate assistant specializing in form validation and compliance analysis. Your task is to analyze a "Déclarations du vendeur" (DV) form based on a detailed validation table that outlines expected responses, required documents, and critical checks for each section (DV1 to DV16).  The first pdf document is the report to analyze. The second xlsx document is the validation table/checklist that provides the criteria for analysis.  You must: Evaluate conformity of each section (DV1 to DV16) by comparing the form content with the validation table.  Find also the name of the person who's selling and who's buying the estate in the signature part.   Identify issues and provide specialized guidance formatted specifically in two key areas: 1. Recommended Actions - Specific steps to take to resolve issues 2. Warnings - Critical issues that need immediate attention  </Instruction>"""
+
+# Markdown template requested by the default specialized analysis
+SPECIALIZED_MARKDOWN_FORMAT = """  Format your output in the following specialized format: # ANALYSIS REPORT: [form number]  </br> ## Document Overview - **Vendor(s)**: [Names] - **Date**: [Date] - **Property Type**: [Type] - **Overall Score**: [score]%  </br> ## 🎯 RECOMMENDED ACTIONS Section: [Section] Action Required: [Specific action] Priority: [High/Medium/Low] Timeline: [Immediate/Within X days]</br> </br>  ## ⚠️ WARNINGS Risk Level: [Critical/High/Medium] Issue: [Issue description] Potential Consequences: [Consequences] Mitigation: [Mitigation approach]</br> </br>  ## Summary Evaluation [Brief summary paragraph with overall assessment]"""
+
+# Appended to the instruction when the analysis is requested as schema-constrained JSON
+SPECIALIZED_JSON_FORMAT = """  Return your analysis as a single JSON object matching the JSON schema given below and nothing else. Use the overall conformity percentage as overall_score, without the % sign. Use empty strings for information that is not present in the form."""
+
+# JSON schema of the specialized result dict, used for structured output and validation
+SPECIALIZED_REPORT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "recommended_actions": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "section": {"type": "string"},
+                    "action_required": {"type": "string"},
+                    "priority": {"type": "string", "enum": ["High", "Medium", "Low"]},
+                    "timeline": {"type": "string"}
+                },
+                "required": ["section", "action_required", "priority", "timeline"],
+                "additionalProperties": False
+            }
+        },
+        "warnings": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "risk_level": {"type": "string", "enum": ["Critical", "High", "Medium"]},
+                    "issue": {"type": "string"},
+                    "potential_consequences": {"type": "string"},
+                    "mitigation": {"type": "string"}
+                },
+                "required": ["risk_level", "issue", "potential_consequences", "mitigation"],
+                "additionalProperties": False
+            }
+        },
+        "vendor": {"type": "string"},
+        "date": {"type": "string"},
+        "property_type": {"type": "string"},
+        "overall_score": {"type": "string"}
+    },
+    "required": ["summary", "recommended_actions", "warnings", "vendor", "date", "property_type", "overall_score"],
+    "additionalProperties": False
+}
+
 # Function to extract text from a PDF file
 def extract_pdf_text(file_content):
-    doc = fitz.open(stream=file_content, filetype="pdf")  # Open the PDF file
-    text = ""
-    for page in doc:  # Iterate through each page
-        text += page.get_text()  # Extract text from the page
-    return text.lower().replace("\n", " ").replace("  ", " ")  # Clean up the text
+    return extract_pdf_text_from(file_content)  # Clean up the text page by page, without full-size copies
 
 # Function to call the Claude AI agent with a prompt
-def call_agent(prompt, model=MODEL, api_key=None):
+def call_agent(prompt, model=MODEL, api_key=None, response_format=None, stats=None, raise_errors=False):
     if api_key is None:
         api_key = OPENROUTER_API_KEY
         
@@ -36,21 +85,36 @@ def call_agent(prompt, model=MODEL, api_key=None):
         "model": model,
         "messages": [{"role": "user", "content": prompt}]
     }
+    if response_format is not None:
+        payload["response_format"] = response_format  # Request schema-constrained output
 
-    # Make a POST request to the AI API
-    response = requests.post(
-        "https://openrouter.ai/api/v1/chat/completions",
-        headers=headers,
-        data=json.dumps(payload)  # Convert payload to JSON
-    )
+    # Make a POST request to the AI API, paced by the shared rate limiter
+    start = time.perf_counter()
+    response = post_chat_completion(payload, headers)
 
     if response.status_code == 200:
-        return response.json()["choices"][0]["message"]["content"]  # Return the AI's response
+        response_json = response.json()
+        if stats is not None:
+            latency = response.elapsed.total_seconds()  # Duration of the HTTP attempt only
+            record_usage(stats, response_json, latency, queue_time=time.perf_counter() - start - latency)
+        return response_json["choices"][0]["message"]["content"]  # Return the AI's response
     else:
         error_message = f"Error: {response.status_code}, {response.text}"
         print(error_message)  # Log error
+        if raise_errors:
+            raise ValueError(error_message)  # Callers expecting structured output cannot use the message
         return error_message
 
+# Function to accumulate token usage, latency and rate limiter wait of an API call into a stats dict
+def record_usage(stats, response_json, latency, queue_time=0.0):
+    usage = response_json.get("usage") or {}
+    stats["calls"] = stats.get("calls", 0) + 1
+    stats["prompt_tokens"] = stats.get("prompt_tokens", 0) + usage.get("prompt_tokens", 0)
+    stats["completion_tokens"] = stats.get("completion_tokens", 0) + usage.get("completion_tokens", 0)
+    stats["latency_s"] = round(stats.get("latency_s", 0.0) + latency, 3)
+    stats["queue_s"] = round(stats.get("queue_s", 0.0) + max(queue_time, 0.0), 3)  # Rate limiter waits and retries
+    return stats
+
 # Function to parse the specialized report into JSON format
 def parse_specialized_report_to_json(report_text):
     """
@@ -137,7 +201,144 @@ def parse_specialized_report_to_json(report_text):
     
     return result
 
-def analyze_real_estate_document_json(pdf_file_content, checklist_file_content, api_key=None):
+# Function to validate a decoded JSON value against a (subset of) JSON schema
+def validate_json_schema(value, schema, path="$"):
+    """
+    Validate a decoded JSON value against the subset of JSON schema used for
+    structured output (object, array, string, number, integer, enum, required, additionalProperties)
+    
+    Args:
+        value: The decoded JSON value to validate
+        schema (dict): The JSON schema to validate against
+        path (str, optional): Location of the value, used in error messages. Defaults to "$".
+        
+    Returns:
+        list: Human readable validation errors, empty when the value is valid
+    """
+    errors = []
+    expected_type = schema.get("type")
+    
+    if expected_type == "object":
+        if not isinstance(value, dict):
+            return [f"{path}: expected an object"]
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}: missing required key '{key}'")
+        for key, item in value.items():
+            if key in properties:
+                errors.extend(validate_json_schema(item, properties[key], f"{path}.{key}"))
+            elif schema.get("additionalProperties") is False:
+                errors.append(f"{path}: unexpected key '{key}'")
+    elif expected_type == "array":
+        if not isinstance(value, list):
+            return [f"{path}: expected an array"]
+        for index, item in enumerate(value):
+            errors.extend(validate_json_schema(item, schema.get("items", {}), f"{path}[{index}]"))
+    elif expected_type == "string" and not isinstance(value, str):
+        errors.append(f"{path}: expected a string")
+    elif expected_type == "number" and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        errors.append(f"{path}: expected a number")
+    elif expected_type == "integer" and (isinstance(value, bool) or not isinstance(value, int)):
+        errors.append(f"{path}: expected an integer")
+    
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: expected one of {schema['enum']}")
+    
+    return errors
+
+# Function to call the AI agent for a JSON answer, validating it and retrying once on invalid output
+def call_agent_json(prompt, schema, schema_name, model=MODEL, api_key=None, stats=None):
+    """
+    Request schema-constrained JSON output from the AI and validate it
+
+    The schema is sent both as response_format and in the prompt, so models
+    without structured output support still see the expected fields.
+    
+    Args:
+        prompt (str): The prompt to send
+        schema (dict): JSON schema the answer must match
+        schema_name (str): Name of the schema sent with the response_format
+        model (str, optional): Model to use. Defaults to MODEL.
+        api_key (str, optional): API key for OpenRouter. Defaults to environment variable.
+        stats (dict, optional): Dict accumulating token usage and latency of the calls
+        
+    Returns:
+        dict: The decoded and validated JSON answer
+        
+    Raises:
+        ValueError: If the API returns an error, or if the answer is still invalid after one retry
+    """
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {"name": schema_name, "strict": True, "schema": schema}
+    }
+    
+    # The schema also goes in the prompt: OpenRouter drops response_format for models without structured output
+    prompt = prompt + f"""\n\n JSON schema: {json.dumps(schema, ensure_ascii=False)}"""
+    
+    attempt_prompt = prompt
+    for attempt in range(2):  # First attempt plus one retry
+        # HTTP errors are raised right away, retrying them with the rejection message cannot help
+        answer = call_agent(attempt_prompt, model=model, api_key=api_key,
+                            response_format=response_format, stats=stats, raise_errors=True)
+        if not isinstance(answer, str):
+            errors = ["empty answer, expected a JSON object"]  # e.g. null message content
+        else:
+            try:
+                # Some providers still wrap the JSON in a markdown code fence
+                data = json.loads(re.sub(r'^```(?:json)?\s*|\s*```$', '', answer.strip()))
+                errors = validate_json_schema(data, schema)
+            except json.JSONDecodeError as e:
+                errors = [f"invalid JSON: {e}"]
+        
+        if not errors:
+            return data
+        
+        # Feed the validation errors back to the model for the retry
+        attempt_prompt = prompt + "\n\n Your previous answer was rejected: " + "; ".join(errors[:10]) + \
+            ". Answer again with only a JSON object matching the schema."
+    
+    raise ValueError(f"Invalid structured output from {model}: {'; '.join(errors[:10])}")
+
+# Function to render the specialized JSON result as the markdown report
+def specialized_json_to_markdown(result):
+    """
+    Render a specialized result dict in the markdown format of the specialized report
+    
+    Args:
+        result (dict): The specialized analysis in JSON format
+        
+    Returns:
+        str: The markdown report
+    """
+    lines = ["# ANALYSIS REPORT", "", "## Document Overview"]
+    lines.append(f"- **Vendor(s)**: {result.get('vendor', '')}")
+    lines.append(f"- **Date**: {result.get('date', '')}")
+    lines.append(f"- **Property Type**: {result.get('property_type', '')}")
+    lines.append(f"- **Overall Score**: {result.get('overall_score', '')}%")
+    
+    lines.extend(["", "## 🎯 RECOMMENDED ACTIONS"])
+    for action in result.get("recommended_actions", []):
+        lines.append(f"Section: {action['section']}")
+        lines.append(f"Action Required: {action['action_required']}")
+        lines.append(f"Priority: {action['priority']}")
+        lines.append(f"Timeline: {action['timeline']}")
+        lines.append("")
+    
+    lines.extend(["", "## ⚠️ WARNINGS"])
+    for warning in result.get("warnings", []):
+        lines.append(f"Risk Level: {warning['risk_level']}")
+        lines.append(f"Issue: {warning['issue']}")
+        lines.append(f"Potential Consequences: {warning['potential_consequences']}")
+        lines.append(f"Mitigation: {warning['mitigation']}")
+        lines.append("")
+    
+    lines.extend(["", "## Summary Evaluation", result.get("summary", "")])
+    
+    return "\n".join(lines)
+
+def analyze_real_estate_document_json(pdf_file_content, checklist_file_content, api_key=None, structured=False, template=None):
     """
     Analyze a real estate document and output only the specialized analysis in JSON format
     
@@ -145,32 +346,47 @@ def analyze_real_estate_document_json(pdf_file_content, checklist_file_content,
         pdf_file_content (bytes): Content of the PDF file to analyze
         checklist_file_content (bytes): Content of the Excel checklist file
         api_key (str, optional): API key for OpenRouter. Defaults to environment variable.
+        structured (bool, optional): Request schema-constrained JSON instead of parsing
+            the markdown report. Defaults to False.
+        template (dict, optional): Learned template of the form version (see form_template);
+            when given only the filled-in content of the form is analyzed. Defaults to None.
         
     Returns:
         dict: A dictionary containing:
             - json_output (dict): The specialized analysis in JSON format
+            - markdown_report (str): The specialized analysis in markdown format
             - json_file (str): Path to the saved JSON file
+            - usage (dict): Token usage and latency of the API calls
             - timestamp (str): Timestamp when the analysis was performed
     """
     try:
-        # Extract text from the uploaded PDF
-        pdf_text = extract_pdf_text(pdf_file_content)
+        # Extract text from the uploaded PDF, without the printed template when it is known
+        if template is not None:
+            pdf_text = extract_filled_text(pdf_file_content, template)
+        else:
+            pdf_text = extract_pdf_text(pdf_file_content)
         
         # Read the checklist from the Excel file
         checklist_buffer = BytesIO(checklist_file_content)
         checklist = pd.read_excel(checklist_buffer)
         
-        # Define specialized prompt
-        specialized_prompt = """<Instruction> You are an expert real estate assistant specializing in form validation and compliance analysis. Your task is to analyze a "Déclarations du vendeur" (DV) form based on a detailed validation table that outlines expected responses, required documents, and critical checks for each section (DV1 to DV16).  The first pdf document is the report to analyze. The second xlsx document is the validation table/checklist that provides the criteria for analysis.  You must: Evaluate conformity of each section (DV1 to DV16) by comparing the form content with the validation table.  Find also the name of the person who's selling and who's buying the estate in the signature part.   Identify issues and provide specialized guidance formatted specifically in two key areas: 1. Recommended Actions - Specific steps to take to resolve issues 2. Warnings - Critical issues that need immediate attention  </Instruction>  Format your output in the following specialized format: # ANALYSIS REPORT: [form number]  </br> ## Document Overview - **Vendor(s)**: [Names] - **Date**: [Date] - **Property Type**: [Type] - **Overall Score**: [score]%  </br> ## 🎯 RECOMMENDED ACTIONS Section: [Section] Action Required: [Specific action] Priority: [High/Medium/Low] Timeline: [Immediate/Within X days]</br> </br>  ## ⚠️ WARNINGS Risk Level: [Critical/High/Medium] Issue: [Issue description] Potential Consequences: [Consequences] Mitigation: [Mitigation approach]</br> </br>  ## Summary Evaluation [Brief summary paragraph with overall assessment]"""
+        usage = {}  # Token usage and latency of the API calls
         
-        # Full prompt with analysis data
-        full_prompt = specialized_prompt + f"""\n\n Analyse:{pdf_text} \n\n Using: {checklist}"""
-        
-        # Call the AI agent for specialized report
-        specialized_report = call_agent(full_prompt, api_key=api_key)
-        
-        # Convert specialized report to JSON structure
-        json_output = parse_specialized_report_to_json(specialized_report)
+        if structured:
+            # Ask for the result dict directly; markdown is derived from it
+            full_prompt = SPECIALIZED_INSTRUCTION + SPECIALIZED_JSON_FORMAT + f"""\n\n Analyse:{pdf_text} \n\n Using: {checklist}"""
+            json_output = call_agent_json(full_prompt, SPECIALIZED_REPORT_SCHEMA, "specialized_report",
+                                          api_key=api_key, stats=usage)
+            specialized_report = specialized_json_to_markdown(json_output)
+        else:
+            # Full prompt with analysis data
+            full_prompt = SPECIALIZED_INSTRUCTION + SPECIALIZED_MARKDOWN_FORMAT + f"""\n\n Analyse:{pdf_text} \n\n Using: {checklist}"""
+            
+            # Call the AI agent for specialized report
+            specialized_report = call_agent(full_prompt, api_key=api_key, stats=usage)
+            
+            # Convert specialized report to JSON structure
+            json_output = parse_specialized_report_to_json(specialized_report)
         
         # Generate timestamp
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -182,7 +398,9 @@ def analyze_real_estate_document_json(pdf_file_content, checklist_file_content,
         
         return {
             "json_output": json_output,
+            "markdown_report": specialized_report,
             "json_file": json_file,
+            "usage": usage,
             "timestamp": timestamp
         }
         
@@ -191,6 +409,7 @@ def analyze_real_estate_document_json(pdf_file_content, checklist_file_content,
         return {
             "error": str(e),
             "json_output": None,
+            "markdown_report": None,
             "json_file": None,
             "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S")
         }
@@ -202,19 +421,29 @@ if __name__ == "__main__":
         pdf_content = pdf_file.read()
         excel_content = excel_file.read()
         
-        results = analyze_real_estate_document_json(
-            pdf_content, 
-            excel_content
-        )
-        
-        if "error" in results:
-            print(f"Analysis failed: {results['error']}")
-        else:
-            print("Analysis completed successfully")
+        # Run the markdown and the structured mode to compare output tokens and latency
+        for structured in (False, True):
+            results = analyze_real_estate_document_json(
+                pdf_content, 
+                excel_content,
+                structured=structured
+            )
+            
+            mode = "structured" if structured else "markdown"
+            if "error" in results:
+                print(f"Analysis failed ({mode}): {results['error']}")
+                continue
+            
+            print(f"Analysis completed successfully ({mode})")
             print(f"JSON output saved to: {results['json_file']}")
             
             # Print summary of JSON content
             json_data = results["json_output"]
             print(f"\nSummary: {json_data['summary'][:100]}...")
             print(f"Recommended Actions: {len(json_data['recommended_actions'])}")
-            print(f"Warnings: {len(json_data['warnings'])}")
\ No newline at end of file
+            print(f"Warnings: {len(json_data['warnings'])}")
+            
+            # Print the cost of the mode
+            usage = results["usage"]
+            print(f"Output tokens: {usage.get('completion_tokens', 0)}")
+            print(f"Latency: {usage.get('latency_s', 0.0)}s\n")
@@ -1,31 +1,67 @@
 import os
-import fitz  # PyMuPDF for PDF handling
 import pandas as pd
 from dotenv import load_dotenv
-import requests
-import json
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
 from reportlab.pdfbase.pdfmetrics import stringWidth
 from datetime import datetime
+from pdf_extraction import extract_pdf_text_from
+from openrouter_client import post_chat_completion
+from specialized_only import call_agent_json, record_usage
+from form_sections import split_sections, normalize_section_label
+import time
 
 # Load API key from environment variables
 load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 MODEL = "anthropic/claude-3-sonnet"  # Model to be used for API calls
+SCREEN_MODEL = "anthropic/claude-3-haiku"  # Cheaper model tried first in the tiered analysis
+ESCALATION_CONFIDENCE = 0.8  # Screening answers below this confidence are escalated to MODEL
+
+# Clause statuses of the local check, by the status names the model answers with
+CLAUSE_STATUSES = {
+    "Conforme": "✅ Conforme",
+    "Partiellement conforme": "🟡 Partiellement conforme",
+    "Non conforme": "🔴 Non conforme"
+}
+
+# Score of each clause status in the tiered analysis, following the rubric of the standard prompt
+CLAUSE_STATUS_SCORES = {"✅ Conforme": 1.0, "🟡 Partiellement conforme": 0.25, "🔴 Non conforme": 0.0}
+
+# Instruction of the model review of the clauses the local check could not settle
+CLAUSE_REVIEW_INSTRUCTION = """<Instruction> You are an expert real estate assistant specializing in form validation and compliance analysis. A keyword check of a "Déclarations du vendeur" (DV) form could not confirm the clauses listed below. For each clause, read the form text and decide whether it is Conforme, Partiellement conforme or Non conforme with respect to its validation elements; the keywords the check did not find are listed for each clause. Give your confidence in the status between 0 and 1 and a one sentence justification. Return a single JSON object matching the JSON schema given below and nothing else, with one entry per listed clause using its ref number. </Instruction>"""
+
+# JSON schema of the model review of clauses
+CLAUSE_REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "clauses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "ref": {"type": "integer"},
+                    "status": {"type": "string", "enum": list(CLAUSE_STATUSES)},
+                    "confidence": {"type": "number"},
+                    "justification": {"type": "string"}
+                },
+                "required": ["ref", "status", "confidence", "justification"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["clauses"],
+    "additionalProperties": False
+}
 
 # Function to extract text from a PDF file
 def extract_pdf_text(file_content):
-    doc = fitz.open(stream=file_content, filetype="pdf")  # Open the PDF file
-    text = ""
-    for page in doc:  # Iterate through each page
-        text += page.get_text()  # Extract text from the page
-    return text.lower().replace("\n", " ").replace("  ", " ")  # Clean up the text
+    return extract_pdf_text_from(file_content)  # Clean up the text page by page, without full-size copies
 
 # Function to call the Claude AI agent with a prompt
-def call_agent(prompt, model=MODEL, api_key=None):
+def call_agent(prompt, model=MODEL, api_key=None, stats=None):
     if api_key is None:
         api_key = OPENROUTER_API_KEY
         
@@ -40,15 +76,16 @@ def call_agent(prompt, model=MODEL, api_key=None):
         "messages": [{"role": "user", "content": prompt}]
     }
 
-    # Make a POST request to the AI API
-    response = requests.post(
-        "https://openrouter.ai/api/v1/chat/completions",
-        headers=headers,
-        data=json.dumps(payload)  # Convert payload to JSON
-    )
+    # Make a POST request to the AI API, paced by the shared rate limiter
+    start = time.perf_counter()
+    response = post_chat_completion(payload, headers)
 
     if response.status_code == 200:
-        return response.json()["choices"][0]["message"]["content"]  # Return the AI's response
+        response_json = response.json()
+        if stats is not None:
+            latency = response.elapsed.total_seconds()  # Duration of the HTTP attempt only
+            record_usage(stats, response_json, latency, queue_time=time.perf_counter() - start - latency)
+        return response_json["choices"][0]["message"]["content"]  # Return the AI's response
     else:
         error_message = f"Error: {response.status_code}, {response.text}"
         print(error_message)  # Log error
@@ -94,7 +131,217 @@ def text_to_pdf(text, max_width=170*mm):
     buffer.seek(0)  # Move to the beginning of the buffer
     return buffer   # Return the buffer containing the PDF
 
-def analyze_real_estate_document(pdf_file_content, checklist_file_content, prompts_dir=None, api_key=None):
+# Function to check each clause of the checklist locally against the PDF text
+def screen_clauses(pdf_text, checklist):
+    """
+    Check the validation elements of each clause against the PDF text
+
+    Args:
+        pdf_text (str): The cleaned text of the PDF
+        checklist (pd.DataFrame): The checklist read from the Excel file
+
+    Returns:
+        list: One dict per clause with ref, clause_id, clause_name, validations, status and missing
+    """
+    clauses = []
+    for index, row in checklist.iterrows():  # Iterate through each row in the checklist
+        clause_id = row["Code form."]  # Get clause ID
+        clause_name = row["Nom de la clause"]  # Get clause name
+        validations = str(row["Éléments de validation"])  # Get validation elements
+
+        status = "✅ Conforme"  # Default status
+        missing = []  # List to hold missing items
+
+        for point in validations.split("-"):  # Check each validation point
+            point = point.strip().lower()  # Clean up the point
+            if point and point not in pdf_text:  # Check if the point is missing in the PDF text
+                status = "🟡 Partiellement conforme"  # Update status if partially compliant
+                missing.append(point)  # Add missing point to the list
+
+        if any("rapport" in m for m in missing):  # Check for specific missing items
+            status = "🔴 Non conforme"  # Update status if non-compliant
+
+        clauses.append({
+            "ref": len(clauses),  # Row of the clause in the checklist, codes may repeat
+            "clause_id": str(clause_id),
+            "clause_name": clause_name,
+            "validations": validations,
+            "status": status,
+            "missing": missing
+        })
+    return clauses
+
+# Function to read the standard prompt, or a default prompt if no directory is given
+def read_standard_prompt(prompts_dir=None):
+    if prompts_dir:
+        std_prompt_file_path = os.path.join(prompts_dir, "standard_prompt.txt")
+        
+        with open(std_prompt_file_path, "r") as f:
+            return f.read()  # Read the standard prompt
+    # Default prompt if path not provided
+    return "Please analyze this real estate document for compliance with the provided checklist."
+
+# Function to build the prompt of the standard analysis from the locally checked clauses
+def build_standard_prompt(std_prompt, clauses, checklist):
+    results = []  # List to hold analysis results
+    for clause in clauses:
+        missing = clause["missing"]
+        # Append the result for this clause
+        results.append(f"### {clause['clause_id']} - {clause['clause_name']}\nStatus: {clause['status']}\nMissing: {', '.join(missing) if missing else 'None'}\n")
+
+    standard_analysis = "".join(results)  # Combine results into a single string
+    return std_prompt + f"""\n\n Analyse:{standard_analysis} \n\n Using:{checklist}"""
+
+# Function to ask a model to review the clauses the local check could not settle
+def review_clauses(pdf_text, clauses, model, api_key=None, stats=None):
+    """
+    Review clauses with a model, using schema-constrained JSON output
+
+    Only the DV sections of the reviewed clauses are sent; the whole text is
+    sent when the section of a clause cannot be found in the document.
+
+    Args:
+        pdf_text (str): The cleaned text of the PDF
+        clauses (list): The clauses to review, as returned by screen_clauses
+        model (str): Model to use
+        api_key (str, optional): API key for OpenRouter. Defaults to environment variable.
+        stats (dict, optional): Dict accumulating token usage and latency of the calls
+
+    Returns:
+        dict: ref of the clause mapped to its review (status, confidence, justification)
+    """
+    sections = {normalize_section_label(label): (label, text) for label, text in split_sections(pdf_text).items()}
+    codes = [normalize_section_label(c["clause_id"]) for c in clauses]
+    if all(code in sections and code != "preamble" for code in codes):
+        document = "\n\n".join(f"### {sections[code][0]}\n{sections[code][1]}" for code in dict.fromkeys(codes))
+    else:
+        document = pdf_text  # Some clause has no matching section, the model needs the whole form
+
+    listed = "\n".join(
+        f"- ref {c['ref']}: {c['clause_id']} - {c['clause_name']}: {c['validations']} (not found: {', '.join(c['missing'])})"
+        for c in clauses
+    )
+    prompt = CLAUSE_REVIEW_INSTRUCTION + f"""\n\n Analyse:{document} \n\n Clauses:\n{listed}"""
+    answer = call_agent_json(prompt, CLAUSE_REVIEW_SCHEMA, "clause_review", model=model, api_key=api_key, stats=stats)
+    return {review["ref"]: review for review in answer["clauses"]}
+
+def analyze_clauses_tiered(pdf_text, checklist, clauses, prompts_dir=None, api_key=None, measure_baseline=False):
+    """
+    Settle clauses in tiers: locally, then with SCREEN_MODEL, then with MODEL
+
+    Clauses the local check proves conforming are settled without the model.
+    The other clauses are reviewed by SCREEN_MODEL, and only the answers with a
+    confidence below ESCALATION_CONFIDENCE (or missing answers) go to MODEL.
+    Clauses no model answered keep their local status under the "unresolved" tier.
+    With measure_baseline, the prompt of the default standard analysis is also
+    sent, so that the token and latency savings are measured rather than estimated.
+
+    Args:
+        pdf_text (str): The cleaned text of the PDF
+        checklist (pd.DataFrame): The checklist read from the Excel file
+        clauses (list): The locally checked clauses, as returned by screen_clauses
+        prompts_dir (str, optional): Directory containing prompt files, used for the
+            baseline standard analysis. Defaults to None.
+        api_key (str, optional): API key for OpenRouter. Defaults to environment variable.
+        measure_baseline (bool, optional): Also run the default standard analysis and
+            report the measured savings. Defaults to False.
+
+    Returns:
+        dict: A dictionary containing:
+            - standard_report (str): The tiered analysis report
+            - standard_pdf (BytesIO): PDF version of the report
+            - tier_stats (dict): Clauses resolved per tier (and left unresolved), token usage and
+              latency per model tier, the errors of the model tiers, and the measured savings
+              against the standard analysis when measure_baseline is set
+            - timestamp (str): Timestamp when the analysis was performed
+
+    Raises:
+        ValueError: If both model tiers fail, so that no clause could be reviewed
+    """
+    screen_usage, main_usage = {}, {}  # Token usage and latency of each model tier
+    errors = {}  # Error of each model tier that failed
+    baseline_prompt = build_standard_prompt(read_standard_prompt(prompts_dir), clauses, checklist)
+
+    # Tier 1: clauses proven conforming by the local check
+    for clause in clauses:
+        if clause["status"] == "✅ Conforme":
+            clause.update(tier="local", justification="All validation elements found in the document")
+    pending = [clause for clause in clauses if "tier" not in clause]
+
+    # Tier 2: cheaper model on the partial and non conforming clauses
+    reviews = {}
+    if pending:
+        try:
+            reviews = review_clauses(pdf_text, pending, SCREEN_MODEL, api_key=api_key, stats=screen_usage)
+        except ValueError as e:
+            print(f"Screening failed, escalating all clauses: {str(e)}")  # Log and escalate everything
+            errors["screen"] = str(e)
+    escalated = []
+    for clause in pending:
+        review = reviews.get(clause["ref"])
+        if review is None or review["confidence"] < ESCALATION_CONFIDENCE:
+            escalated.append(clause)
+        else:
+            clause.update(tier="screen", status=CLAUSE_STATUSES[review["status"]], justification=review["justification"])
+
+    # Tier 3: main model on the low confidence clauses
+    if escalated:
+        reviews = {}
+        try:
+            reviews = review_clauses(pdf_text, escalated, MODEL, api_key=api_key, stats=main_usage)
+        except ValueError as e:
+            print(f"Review failed, keeping the local check results: {str(e)}")  # Log and keep what is settled
+            errors["main"] = str(e)
+            if "screen" in errors:  # No model answered at all, the analysis did not happen
+                raise ValueError(f"Clause review failed: screening: {errors['screen']}; main: {errors['main']}")
+        for clause in escalated:
+            review = reviews.get(clause["ref"])
+            if review is None:  # Keep the local result when no model answered for the clause
+                clause.update(tier="unresolved", justification="Not reviewed by the model, local check result kept")
+            else:
+                clause.update(tier="main", status=CLAUSE_STATUSES[review["status"]], justification=review["justification"])
+
+    tier_stats = {
+        "local": sum(c["tier"] == "local" for c in clauses),
+        "screen": sum(c["tier"] == "screen" for c in clauses),
+        "main": sum(c["tier"] == "main" for c in clauses),
+        "unresolved": sum(c["tier"] == "unresolved" for c in clauses),
+        "screen_usage": screen_usage,
+        "main_usage": main_usage,
+        "errors": errors
+    }
+
+    if measure_baseline:
+        # Run the default standard analysis on the same clauses and compare the measured costs
+        baseline_usage = {}
+        call_agent(baseline_prompt, api_key=api_key, stats=baseline_usage)
+        tiered_usage = {key: screen_usage.get(key, 0) + main_usage.get(key, 0)
+                        for key in ("prompt_tokens", "completion_tokens", "latency_s")}
+        tier_stats["baseline_usage"] = baseline_usage
+        tier_stats["savings"] = {key: round(baseline_usage.get(key, 0) - tiered_usage[key], 3) for key in tiered_usage}
+
+    # Score following the rubric of the standard prompt
+    score = round(100 * sum(CLAUSE_STATUS_SCORES[c["status"]] for c in clauses) / len(clauses)) if clauses else 0
+
+    lines = ["# Tiered Compliance Analysis", "", f"**Conformity Score**: {score}%", "",
+             "| Clause | Status | Resolved by | Justification |", "| --- | --- | --- | --- |"]
+    for c in clauses:
+        lines.append(f"| {c['clause_id']} - {c['clause_name']} | {c['status']} | {c['tier']} | {c['justification']} |")
+    lines.extend(["", f"Clauses resolved locally: {tier_stats['local']}",
+                  f"Clauses resolved by {SCREEN_MODEL}: {tier_stats['screen']}",
+                  f"Clauses resolved by {MODEL}: {tier_stats['main']}",
+                  f"Clauses not reviewed by a model: {tier_stats['unresolved']}"])
+    standard_report = "\n".join(lines)
+
+    return {
+        "standard_report": standard_report,
+        "standard_pdf": text_to_pdf(standard_report),
+        "tier_stats": tier_stats,
+        "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S")
+    }
+
+def analyze_real_estate_document(pdf_file_content, checklist_file_content, prompts_dir=None, api_key=None, tiered=False,
+                                  measure_baseline=False):
     """
     Analyze a real estate document against a compliance checklist and provide only standard report
     
@@ -103,11 +350,16 @@ def analyze_real_estate_document(pdf_file_content, checklist_file_content, promp
         checklist_file_content (bytes): Content of the Excel checklist file
         prompts_dir (str, optional): Directory containing prompt files. Defaults to None.
         api_key (str, optional): API key for OpenRouter. Defaults to environment variable.
+        tiered (bool, optional): Settle conforming clauses locally and send only the other
+            clauses to the model (see analyze_clauses_tiered). Defaults to False.
+        measure_baseline (bool, optional): In tiered mode, also run the default analysis
+            to measure the savings. Defaults to False.
         
     Returns:
         dict: A dictionary containing:
             - standard_report (str): The standard analysis report
             - standard_pdf (BytesIO): PDF version of the standard report
+            - tier_stats (dict): Clauses resolved per tier and model usage, in tiered mode only
             - timestamp (str): Timestamp when the analysis was performed
     """
     try:
@@ -118,44 +370,17 @@ def analyze_real_estate_document(pdf_file_content, checklist_file_content, promp
         checklist_buffer = BytesIO(checklist_file_content)
         checklist = pd.read_excel(checklist_buffer)
         
-        results = []  # List to hold analysis results
-        for index, row in checklist.iterrows():  # Iterate through each row in the checklist
-            clause_id = row["Code form."]  # Get clause ID
-            clause_name = row["Nom de la clause"]  # Get clause name
-            validations = str(row["Éléments de validation"])  # Get validation elements
-
-            status = "✅ Conforme"  # Default status
-            missing = []  # List to hold missing items
-
-            for point in validations.split("-"):  # Check each validation point
-                point = point.strip().lower()  # Clean up the point
-                if point and point not in pdf_text:  # Check if the point is missing in the PDF text
-                    status = "🟡 Partiellement conforme"  # Update status if partially compliant
-                    missing.append(point)  # Add missing point to the list
+        clauses = screen_clauses(pdf_text, checklist)  # Local check of each clause of the checklist
 
-            if any("rapport" in m for m in missing):  # Check for specific missing items
-                status = "🔴 Non conforme"  # Update status if non-compliant
+        if tiered:
+            return analyze_clauses_tiered(pdf_text, checklist, clauses, prompts_dir=prompts_dir, api_key=api_key,
+                                          measure_baseline=measure_baseline)
 
-            # Append the result for this clause
-            results.append(f"### {clause_id} - {clause_name}\nStatus: {status}\nMissing: {', '.join(missing) if missing else 'None'}\n")
-
-        standard_analysis = "".join(results)  # Combine results into a single string
-        
         # Corrected from original code - don't overwrite the analysis with pdf_text
         # standard_analysis = pdf_text  # This was a bug in the original code
 
-        # Prompts for AI analysis
-        if prompts_dir:
-            std_prompt_file_path = os.path.join(prompts_dir, "standard_prompt.txt")
-            
-            with open(std_prompt_file_path, "r") as f:
-                std_prompt = f.read()  # Read the standard prompt
-        else:
-            # Default prompt if path not provided
-            std_prompt = "Please analyze this real estate document for compliance with the provided checklist."
-
         # Prepare prompt for the AI
-        standard_prompt = std_prompt + f"""\n\n Analyse:{standard_analysis} \n\n Using:{checklist}"""
+        standard_prompt = build_standard_prompt(read_standard_prompt(prompts_dir), clauses, checklist)
 
         # Call the AI agent for standard report only
         standard_report = call_agent(standard_prompt, api_key=api_key)  # Get standard report
@@ -202,4 +427,24 @@ if __name__ == "__main__":
             
             # Save PDF for testing
             with open(f"standard_report_{results['timestamp']}.pdf", "wb") as f:
-                f.write(results['standard_pdf'].getvalue())
\ No newline at end of file
+                f.write(results['standard_pdf'].getvalue())
+        
+        # Tiered analysis of the same document, reporting what each tier resolved
+        results = analyze_real_estate_document(
+            pdf_content, 
+            excel_content,
+            prompts_dir="/Users/a1/Documents/GitHub/real_estate_compliance_analyzer/",
+            tiered=True,
+            measure_baseline=True
+        )
+        
+        if "error" in results:
+            print(f"Tiered analysis failed: {results['error']}")
+        else:
+            tier_stats = results["tier_stats"]
+            print(f"Clauses resolved locally / screen / main / unresolved: {tier_stats['local']} / {tier_stats['screen']} / {tier_stats['main']} / {tier_stats['unresolved']}")
+            for tier in ("screen_usage", "main_usage"):
+                usage = tier_stats[tier]
+                print(f"{tier}: {usage.get('prompt_tokens', 0)} prompt tokens, {usage.get('completion_tokens', 0)} output tokens, {usage.get('latency_s', 0.0)}s")
+            savings = tier_stats["savings"]
+            print(f"Savings against the standard analysis: {savings['prompt_tokens']} prompt tokens, {savings['completion_tokens']} output tokens, {savings['latency_s']}s")